@@ -1,28 +1,91 @@
 """
-A simple class for loading and storing JSON documents in a local file
+A simple class for loading and storing JSON or MessagePack documents in a local file
 """
 
+import hashlib
 import json
-import os.path
+import logging
+import os
 import pprint
-from datetime import datetime
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+# File suffixes stored as MessagePack unless a serializer is given
+_MSGPACK_SUFFIXES = (".msgpack", ".mp")
+
+
+def _dumps(document, serializer="json"):
+    """
+    Serialize a document to MessagePack bytes, or to JSON bytes
+    with sorted namespaces using orjson when it is installed.
+    """
+    if serializer == "msgpack":
+        return msgpack.packb(document)
+    ordered = dict(sorted(document.items()))
+    if orjson is not None:
+        return orjson.dumps(ordered, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(ordered, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def _loads(document, serializer="json"):
+    """
+    Deserialize MessagePack bytes, or JSON bytes using orjson
+    when it is installed.
+    """
+    if serializer == "msgpack":
+        return msgpack.unpackb(document, raw=False)
+    if orjson is not None:
+        return orjson.loads(document)
+    return json.loads(document)
 
 
 class ParameterStore:
     """
     Create a parameter store with namespace functionality
-    that stores keys and values in a local JSON file
+    that stores keys and values in a local JSON or MessagePack file
     """
 
     def __init__(
-        self, path="", parameters={}, filename="parameters.json", verbose=True
+        self,
+        path="",
+        parameters=None,
+        filename="parameters.json",
+        verbose=True,
+        serializer=None,
     ):
         """
         Constructor
+
+        The serializer is either "json" or "msgpack". By default it is
+        "msgpack" for filenames ending in .msgpack or .mp and "json" otherwise.
         """
+        parameters = {} if parameters is None else parameters
         self.filename = path + filename
+        if serializer is None:
+            serializer = (
+                "msgpack" if self.filename.endswith(_MSGPACK_SUFFIXES) else "json"
+            )
+        if serializer not in ("json", "msgpack"):
+            raise ValueError(f"Unsupported serializer: {serializer}")
+        if serializer == "msgpack" and msgpack is None:
+            raise ImportError("The msgpack serializer requires the msgpack package")
+        self.serializer = serializer
         self.verbose = verbose
         self.namespace = "experiment_1"
+        self.sync_every = None
+        self._unsynced_stores = 0
+        self._stored_digest = None
 
         # If the file already exists, load up the params
         if os.path.exists(self.filename):
@@ -31,6 +94,39 @@ class ParameterStore:
         # Otherwise set params to be empty
         else:
             self.parameters = parameters
+        self._bind_namespace()
+
+    def _bind_namespace(self):
+        """
+        Cache the dictionary of the current namespace, or None
+        if the namespace does not exist yet.
+
+        :return: None
+        """
+        self._ns = self.parameters.get(self.namespace)
+
+    def _namespace_parameters(self):
+        """
+        Return the dictionary of the current namespace,
+        creating the namespace if it does not exist yet.
+
+        :return: dict
+        """
+        if self._ns is None:
+            self._ns = self.parameters[self.namespace] = {}
+        return self._ns
+
+    def _debug(self, message, document):
+        """
+        Log a document at debug level. Formatting is skipped entirely
+        unless verbose is set and debug logging is enabled.
+
+        :param message: str
+        :param document: dict
+        :return: None
+        """
+        if self.verbose and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s\n%s", message, pprint.pformat(document))
 
     def set_namespace(self, namespace):
         """
@@ -40,8 +136,9 @@ class ParameterStore:
         :return: None
         """
         self.namespace = namespace
+        self._bind_namespace()
 
-    def create(self, parameters={}):
+    def create(self, parameters=None):
         """
         Create a new parameter store with the option of
         separating keys and values by namespace.
@@ -49,58 +146,41 @@ class ParameterStore:
         :param parameters: dict
         :return: None
         """
-        self.parameters[self.namespace] = parameters
-        if self.verbose:
-            print(f"Creating : \n")
-            pprint.pprint(parameters)
+        parameters = {} if parameters is None else parameters
+        self._ns = self.parameters[self.namespace] = parameters
+        self._debug("Creating :", parameters)
 
     def read(self):
         """
         Return a dictionary of parameters
-        belonging to a namespace
+        belonging to a namespace, or None if the namespace does not exist
 
         :return: dict
         """
-        try:
-            if self.parameters:
-                if self.verbose:
-                    print(f"Reading : {self.namespace}\n")
-                    pprint.pprint(self.parameters)
-                return self.parameters[self.namespace]
-            else:
-                return None
+        self._debug(f"Reading : {self.namespace}", self._ns)
+        return self._ns
 
-        except Exception as inst:
-            print(type(inst))  # the exception instance
-            print(inst.args)  # arguments stored in .args
-            print(inst)
-
-    def read_all(self, parameters={}):
+    def read_all(self, parameters=None):
         """
         Return entire dictionary of parameters
 
         :param parameters: dict
+        :return: dict
         """
-        if self.parameters:
-            pprint(self.parameters)
+        self._debug("Reading all :", self.parameters)
+        return self.parameters
 
-    def add(self, parameters={}):
+    def add(self, parameters=None):
         """
-        Add new parameters including updating old ones with new values
+        Add new parameters including updating old ones with new values.
+        The namespace is created if it does not exist yet.
 
         :param parameters: dict
         :return: None
         """
-        try:
-            self.parameters[self.namespace].update(parameters)
-            if self.verbose:
-                print(f"Updating Params : \n")
-                pprint.pprint(parameters)
-
-        except Exception as inst:
-            print(type(inst))  # the exception instance
-            print(inst.args)  # arguments stored in .args
-            print(inst)
+        parameters = {} if parameters is None else parameters
+        self._namespace_parameters().update(parameters)
+        self._debug("Updating Params :", parameters)
 
     def delete(self, key):
         """
@@ -109,8 +189,9 @@ class ParameterStore:
         :param key: str
         :return: None
         """
-
-        self.parameters[self.namespace].__delitem__(key)
+        if self._ns is None:
+            raise KeyError(key)
+        del self._ns[key]
 
     def clear(self):
         """
@@ -118,7 +199,7 @@ class ParameterStore:
 
         :return: None
         """
-        self.parameters[self.namespace] = {}
+        self._ns = self.parameters[self.namespace] = {}
 
     def clear_all(self):
         """
@@ -127,6 +208,7 @@ class ParameterStore:
         :return: None
         """
         self.parameters = {}
+        self._ns = None
 
     def load(self):
         """
@@ -135,31 +217,61 @@ class ParameterStore:
 
         :return: None
         """
-        with open(self.filename, "r") as file:
+        with open(self.filename, "rb") as file:
             document = file.read()
 
-        self.parameters = json.loads(document)
-        if self.verbose:
-            print(f"Loading : \n")
-            pprint.pprint(self.parameters)
+        self.parameters = _loads(document, self.serializer)
+        self._bind_namespace()
+        self._stored_digest = hashlib.sha256(document).digest()
+        self._debug("Loading :", self.parameters)
+
+    def store_batch(self, n):
+        """
+        Only fsync the parameter file once every n calls to store,
+        unless a store explicitly asks to be durable.
+
+        :param n: int
+        :return: None
+        """
+        self.sync_every = n
 
-    def store(self):
+    def store(self, durable=False):
         """
-        Save the updates to the parameter store
+        Save the updates to the parameter store. The file is written
+        to a temporary file first and atomically renamed over the old one.
+        Nothing is written if the serialized parameters are the same as
+        the last loaded or stored file.
 
+        :param durable: bool, fsync the file before renaming it
         :return: None
         """
-        ordered = dict(sorted(self.parameters.items()))
-        self.parameters = ordered
+        # Compare the full document, so changes made through dictionaries
+        # returned by read or passed to create and add are also saved
+        document = _dumps(self.parameters, self.serializer)
+        if hashlib.sha256(document).digest() == self._stored_digest:
+            return
 
-        # get and update datetime for when you are storing
-        now = datetime.now()
-        dt_string = now.strftime("%d/%m/%Y %H:%M:%S")
-        print("date and time: ", dt_string)
+        # record when the namespace was stored, as seconds since the epoch
+        self._namespace_parameters()["__timestamp"] = int(time.time())
+        document = _dumps(self.parameters, self.serializer)
+        self._debug("Storing :", self.parameters)
 
-        self.add({"__timestamp": dt_string})
-        if self.verbose:
-            print(f"Storing : \n")
-            pprint.pprint(self.parameters)
-        with open(self.filename, "w") as file:
-            file.write(json.dumps(self.parameters))
+        self._unsynced_stores += 1
+        if self.sync_every and self._unsynced_stores >= self.sync_every:
+            durable = True
+
+        tmp_filename = self.filename + ".tmp"
+        try:
+            with open(tmp_filename, "wb") as file:
+                file.write(document)
+                if durable:
+                    file.flush()
+                    os.fsync(file.fileno())
+                    self._unsynced_stores = 0
+            os.replace(tmp_filename, self.filename)
+        except BaseException:
+            # don't leave a partial temporary file behind
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+        self._stored_digest = hashlib.sha256(document).digest()
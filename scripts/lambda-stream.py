@@ -1,18 +1,46 @@
 import json
 import base64
+import logging
 import subprocess
 import os
 import sys
 from datetime import datetime
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+from botocore.config import Config
+
+# orjson is only used when it is packaged with the function
+try:
+    import orjson
+
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
 
 print(f"boto3 version: {boto3.__version__}")
 
+# Clients are created once per container and reused across warm invocations.
+# The pool is sized above EXECUTOR's worker count so parallel writes never wait
+# on a connection, and adaptive retries back off client-side when throttled.
+config_options = {
+    "max_pool_connections": 64,
+    "retries": {"mode": "adaptive", "max_attempts": 10},
+}
+
 try:
-    sm = boto3.Session().client(service_name="sagemaker")
-    sm_fs = boto3.Session().client(service_name="sagemaker-featurestore-runtime")
+    try:
+        config = Config(tcp_keepalive=True, **config_options)
+    except TypeError:
+        # Older botocore releases do not support tcp_keepalive
+        config = Config(**config_options)
+    sm_fs = boto3.Session().client(
+        service_name="sagemaker-featurestore-runtime", config=config
+    )
 except:
     print(f"Failed while connecting to SageMaker Feature Store")
     print(f"Unexpected error: {sys.exc_info()[0]}")
@@ -20,11 +48,18 @@ except:
 # Read Environment Vars
 CUSTOMER_ACTIVITY_FEATURE_GROUP = os.environ["click_stream_feature_group_name"]
 
+# Worker pool kept alive across warm invocations, records are written
+# concurrently with one put_record call each
+EXECUTOR = ThreadPoolExecutor(max_workers=32)
+
 
 def ingest_record(
-    fg_name, customer_id, sum_activity_weight_last_2m, avg_product_health_index_last_2m
+    customer_id,
+    sum_activity_weight_last_2m,
+    avg_product_health_index_last_2m,
+    event_time,
 ):
-    record = [
+    return [
         {"FeatureName": "customer_id", "ValueAsString": str(customer_id)},
         {
             "FeatureName": "sum_activity_weight_last_2m",
@@ -34,44 +69,73 @@ def ingest_record(
             "FeatureName": "avg_product_health_index_last_2m",
             "ValueAsString": str(avg_product_health_index_last_2m),
         },
-        {
-            "FeatureName": "event_time",
-            "ValueAsString": str(int(round(time.time()))),
-        },
+        {"FeatureName": "event_time", "ValueAsString": event_time},
     ]
-    sm_fs.put_record(FeatureGroupName=fg_name, Record=record)
-    return
+
+
+def put_record(entry):
+    try:
+        sm_fs.put_record(
+            FeatureGroupName=entry["FeatureGroupName"], Record=entry["Record"]
+        )
+        return True
+    except Exception as e:
+        logger.error("Failed to ingest record: %s", e)
+        return False
+
+
+def parallel_put_records(entries):
+    # Overlap the put_record round trips, results come back in submission order
+    futures = [EXECUTOR.submit(put_record, entry) for entry in entries]
+    return [future.result() for future in futures]
 
 
 def lambda_handler(event, context):
     inv_id = event["invocationId"]
     app_arn = event["applicationArn"]
     records = event["records"]
-    print(
-        f"Received {len(records)} records, invocation id: {inv_id}, app arn: {app_arn}"
+    logger.info(
+        "Received %d records, invocation id: %s, app arn: %s",
+        len(records),
+        inv_id,
+        app_arn,
     )
+    debug = logger.isEnabledFor(logging.DEBUG)
 
-    ret_records = []
+    event_time = str(int(round(time.time())))
+    entries = []
     for rec in records:
-        data = rec["data"]
-        agg_data_str = base64.b64decode(data)
-        agg_data = json.loads(agg_data_str)
-        print(agg_data)
+        agg_data = loads(base64.b64decode(rec["data"]))
 
         customer_id = agg_data["CUSTOMER_ID"]
         sum_activity_weight_last_2m = agg_data["SUM_ACTIVITY_WEIGHT_LAST_2M"]
         avg_product_health_index_last_2m = agg_data["AVG_PRODUCT_HEALTH_INDEX_LAST_2M"]
-        print(
-            f"Updating agg features for customerId: {customer_id}, Sum of activity weight last 2m: {sum_activity_weight_last_2m}, Average product health index last 2m: {avg_product_health_index_last_2m}"
-        )
-        ingest_record(
-            CUSTOMER_ACTIVITY_FEATURE_GROUP,
-            customer_id,
-            sum_activity_weight_last_2m,
-            avg_product_health_index_last_2m,
+        if debug:
+            logger.debug(
+                "Updating agg features for customerId: %s, Sum of activity weight last 2m: %s, Average product health index last 2m: %s",
+                customer_id,
+                sum_activity_weight_last_2m,
+                avg_product_health_index_last_2m,
+            )
+        entries.append(
+            {
+                "FeatureGroupName": CUSTOMER_ACTIVITY_FEATURE_GROUP,
+                "Record": ingest_record(
+                    customer_id,
+                    sum_activity_weight_last_2m,
+                    avg_product_health_index_last_2m,
+                    event_time,
+                ),
+            }
         )
 
-        # Flag each record as being "Ok", so that Kinesis won't try to re-send
-        ret_records.append({"recordId": rec["recordId"], "result": "Ok"})
-    return {"records": ret_records}
+    succeeded = parallel_put_records(entries)
+    logger.info("Updated %d customers in invocation %s", sum(succeeded), inv_id)
 
+    # Flag each written record as being "Ok", so that Kinesis won't try to re-send,
+    # and the failed ones as "DeliveryFailed" so that they are retried
+    ret_records = []
+    for rec, ok in zip(records, succeeded):
+        result = "Ok" if ok else "DeliveryFailed"
+        ret_records.append({"recordId": rec["recordId"], "result": result})
+    return {"records": ret_records}
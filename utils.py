@@ -1,14 +1,19 @@
 """Helper functions for workshop
 """
 
+import numpy as np
 import pandas as pd
-from sagemaker.feature_store.feature_group import FeatureGroup
+from sagemaker.feature_store.feature_group import FeatureGroup, IngestionError
 import time
 import boto3
 import sagemaker
 from sagemaker.serializers import JSONSerializer
+import io
 import os
 import json
+import random
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
 from sagemaker.feature_store.feature_definition import (
     FeatureDefinition,
     FeatureTypeEnum,
@@ -30,11 +35,26 @@ feature_store_session = Session(
 )
 
 
+# Athena column types read back as numbers by _get_query_results_as_dataframe
+_ATHENA_NUMERIC_TYPES = {
+    "tinyint",
+    "smallint",
+    "integer",
+    "bigint",
+    "float",
+    "real",
+    "double",
+    "decimal",
+}
+
+# Ingestions started with wait=False, joined by flush_ingestion()
+_pending_ingestions = []
+
+
 class FMSerializer(JSONSerializer):
     def serialize(self, data):
-        js = {"instances": []}
-        for row in data:
-            js["instances"].append({"features": row.tolist()})
+        # Convert the whole matrix to nested lists in one call
+        js = {"instances": [{"features": row} for row in np.asarray(data).tolist()]}
         return json.dumps(js)
 
 
@@ -76,6 +96,21 @@ def query_offline_store(
         )
 
 
+def _backoff_delay(attempt, base, cap):
+    """Get an exponential backoff delay with jitter
+
+    Args:
+        attempt (int): Number of polls made so far
+        base (float): Delay in seconds before the second poll
+        cap (float): Maximum delay in seconds
+
+    Returns:
+        float: Seconds to sleep before polling again
+    """
+    # Clamp the exponent so long waits cannot overflow a float base
+    return min(cap, base * 2 ** min(attempt, 16)) + random.uniform(0, 0.25)
+
+
 def wait_for_feature_group_creation_complete(feature_group):
     """Wait for a FeatureGroup to finish creating
 
@@ -84,9 +119,11 @@ def wait_for_feature_group_creation_complete(feature_group):
     """
     status = feature_group.describe().get("FeatureGroupStatus")
     print(f"Initial status: {status}")
+    attempt = 0
     while status == "Creating":
         print(f"Waiting for feature group: {feature_group.name} to be created ...")
-        time.sleep(5)
+        time.sleep(_backoff_delay(attempt, base=1, cap=15))
+        attempt += 1
         status = feature_group.describe().get("FeatureGroupStatus")
     if status != "Created":
         raise SystemExit(
@@ -115,17 +152,12 @@ def get_feature_definitions(df, feature_group):
 
     # Our schema of our data that we expect
     # _after_ SageMaker Processing
-    feature_definitions = []
-    for column in df.columns:
-        feature_type = feature_group._DTYPE_TO_FEATURE_DEFINITION_CLS_MAP.get(
-            str(df[column].dtype), None
-        )
-        if not feature_type:
-            feature_type = FeatureTypeEnum.STRING
-        feature_definitions.append(
-            FeatureDefinition(column, feature_type)
-        )  # You can alternatively define your own schema
-    return feature_definitions
+    # You can alternatively define your own schema
+    mapping = feature_group._DTYPE_TO_FEATURE_DEFINITION_CLS_MAP
+    return [
+        FeatureDefinition(column, mapping.get(str(dtype), FeatureTypeEnum.STRING))
+        for column, dtype in df.dtypes.items()
+    ]
 
 
 def create_feature_group(
@@ -146,11 +178,14 @@ def create_feature_group(
     # Add event time to df
     event_time_name = "event_time"
     current_time_sec = int(round(time.time()))
-    df["event_time"] = pd.Series([current_time_sec] * len(df), dtype="float64")
+    df["event_time"] = np.float64(current_time_sec)
 
     # If the df doesn't have an id column, add it
     if record_id not in df.columns:
-        df[record_id] = df.index
+        if pd.api.types.is_integer_dtype(df.index):
+            df[record_id] = df.index.astype("int64")
+        else:
+            df[record_id] = df.index
 
     feature_group = FeatureGroup(
         name=feature_group_name, sagemaker_session=sagemaker_session
@@ -189,25 +224,106 @@ def get_feature_group_table_name(feature_group):
     return feature_group.athena_query().table_name
 
 
-def ingest_data_into_feature_group(df, feature_group):
-    """Ingest data into a feature goup
+def _wait_for_ingestion(feature_group, ingestion_manager, num_records):
+    """Wait for an ingestion to finish and report failed rows
 
     Args:
-        df (pandas.DataFrame): Dataframe
         feature_group (FeatureGroup): Feature group
+        ingestion_manager (IngestionManagerPandas): Ingestion manager returned by ingest
+        num_records (int): Number of records submitted
     """
-    print(f"Ingesting data into feature group: {feature_group.name}...")
     try:
-        ingestion_manager = feature_group.ingest(
-            data_frame=df, max_workers=16, max_processes=16, wait=True
-        )
-    except Exception as e:
+        ingestion_manager.wait()
+    except IngestionError as e:
         print(e)
-        failed_rows = ingestion_manager.failed_rows()
+        failed_rows = e.failed_rows
         num_failed_rows = len(failed_rows)
         print(f"Num failed rows: {num_failed_rows}")
         print(f"Failed rows: {failed_rows}")
-    print(f"{len(df)} records ingested into feature group: {feature_group.name}")
+    print(f"{num_records} records ingested into feature group: {feature_group.name}")
+
+
+def ensure_provisioned(fg_name, wcu, rcu=None):
+    """Switch a feature group to provisioned throughput and wait for the update
+
+    Args:
+        fg_name (str): Feature group name
+        wcu (int): Provisioned write capacity units
+        rcu (int, optional): Provisioned read capacity units. Defaults to the feature
+            group's current RCU, and is required if it is not provisioned yet.
+    """
+    throughput_config = describe_feature_group(fg_name).get("ThroughputConfig", {})
+    if rcu is None and throughput_config.get("ThroughputMode") == "Provisioned":
+        rcu = throughput_config.get("ProvisionedReadCapacityUnits")
+    if rcu is None:
+        raise ValueError(
+            f"Feature group {fg_name} is not provisioned, read capacity units are required"
+        )
+    if (
+        throughput_config.get("ThroughputMode") == "Provisioned"
+        and throughput_config.get("ProvisionedWriteCapacityUnits") == wcu
+        and throughput_config.get("ProvisionedReadCapacityUnits") == rcu
+    ):
+        return
+
+    print(f"Provisioning feature group {fg_name} with {wcu} WCU and {rcu} RCU")
+    sagemaker_client.update_feature_group(
+        FeatureGroupName=fg_name,
+        ThroughputConfig={
+            "ThroughputMode": "Provisioned",
+            "ProvisionedWriteCapacityUnits": wcu,
+            "ProvisionedReadCapacityUnits": rcu,
+        },
+    )
+    attempt = 0
+    status = "InProgress"
+    while status == "InProgress":
+        time.sleep(_backoff_delay(attempt, base=1, cap=15))
+        attempt += 1
+        last_update_status = describe_feature_group(fg_name).get("LastUpdateStatus", {})
+        status = last_update_status.get("Status")
+    if status != "Successful":
+        raise SystemExit(
+            f"Failed to update feature group {fg_name}: {last_update_status.get('FailureReason')}"
+        )
+
+
+def ingest_data_into_feature_group(
+    df, feature_group, wait=True, write_capacity_units=None, read_capacity_units=None
+):
+    """Ingest data into a feature goup
+
+    Args:
+        df (pandas.DataFrame): Dataframe
+        feature_group (FeatureGroup): Feature group
+        wait (bool, optional): Wait for the ingestion to finish. Otherwise it runs in
+            the background until flush_ingestion() is called. Defaults to True.
+        write_capacity_units (int, optional): Switch the feature group to provisioned
+            throughput with this many WCU before ingesting. Defaults to None.
+        read_capacity_units (int, optional): Provisioned RCU to use together with
+            write_capacity_units. Defaults to the feature group's current RCU, and is
+            required if it is not provisioned yet.
+    """
+    if write_capacity_units is not None:
+        ensure_provisioned(
+            feature_group.name, write_capacity_units, read_capacity_units
+        )
+    print(f"Ingesting data into feature group: {feature_group.name}...")
+    # Ingestion is network bound, so use more threads than cores
+    max_workers = (os.cpu_count() or 1) * 4
+    ingestion_manager = feature_group.ingest(
+        data_frame=df, max_workers=max_workers, max_processes=16, wait=False
+    )
+    if wait:
+        _wait_for_ingestion(feature_group, ingestion_manager, len(df))
+    else:
+        _pending_ingestions.append((feature_group, ingestion_manager, len(df)))
+
+
+def flush_ingestion():
+    """Wait for every ingestion started with wait=False to finish"""
+    while _pending_ingestions:
+        _wait_for_ingestion(*_pending_ingestions.pop(0))
 
 
 def _get_offline_details(fg_name, sagemaker_session, s3_uri=None):
@@ -233,7 +349,41 @@ def _get_offline_details(fg_name, sagemaker_session, s3_uri=None):
     return _table, _database, _tmp_uri
 
 
-def _run_query(query_string, tmp_uri, database, region, verbose=True):
+def _get_query_results_as_dataframe(athena, query_execution_id):
+    """Read the results of a small athena query inline, without going through S3
+
+    Args:
+        athena (boto3.client): Athena client
+        query_execution_id (str): Query execution id
+
+    Returns:
+        pandas.DataFrame: Dataframe
+    """
+    paginator = athena.get_paginator("get_query_results")
+    column_info = None
+    rows = []
+    for page in paginator.paginate(
+        QueryExecutionId=query_execution_id, PaginationConfig={"PageSize": 1000}
+    ):
+        result_set = page["ResultSet"]
+        page_rows = result_set["Rows"]
+        if column_info is None:
+            column_info = result_set["ResultSetMetadata"]["ColumnInfo"]
+            # The first row of the first page holds the column names
+            page_rows = page_rows[1:]
+        rows.extend(
+            [datum.get("VarCharValue") for datum in row["Data"]] for row in page_rows
+        )
+    df = pd.DataFrame(rows, columns=[column["Name"] for column in column_info])
+    for column in column_info:
+        if column["Type"] in _ATHENA_NUMERIC_TYPES:
+            df[column["Name"]] = pd.to_numeric(df[column["Name"]])
+    return df
+
+
+def _run_query(
+    query_string, tmp_uri, database, region, verbose=True, small_result=False
+):
     """Run athena query (used to get a feature group count)
 
     Args:
@@ -242,6 +392,9 @@ def _run_query(query_string, tmp_uri, database, region, verbose=True):
         database (str): Database name
         region (str): Region name
         verbose (bool, optional): Verbose output. Defaults to True.
+        small_result (bool, optional): Read the result inline with paginated
+            get_query_results calls instead of downloading the result file.
+            Defaults to False.
 
     Returns:
         pandas.DataFrame: Dataframe
@@ -263,8 +416,10 @@ def _run_query(query_string, tmp_uri, database, region, verbose=True):
     query_state = athena.get_query_execution(QueryExecutionId=query_execution_id)[
         "QueryExecution"
     ]["Status"]["State"]
+    attempt = 0
     while query_state != "SUCCEEDED" and query_state != "FAILED":
-        time.sleep(2)
+        time.sleep(_backoff_delay(attempt, base=0.5, cap=30))
+        attempt += 1
         query_state = athena.get_query_execution(QueryExecutionId=query_execution_id)[
             "QueryExecution"
         ]["Status"]["State"]
@@ -281,15 +436,22 @@ def _run_query(query_string, tmp_uri, database, region, verbose=True):
         results_file_prefix = f"offline-store/query_results/{query_execution_id}.csv"
 
         # Prepare query results for training.
-        filename = "query_results.csv"
         results_bucket = (tmp_uri.split("//")[1]).split("/")[0]
-        s3_client.download_file(results_bucket, results_file_prefix, filename)
-        df = pd.read_csv("query_results.csv")
-        os.remove("query_results.csv")
-
-        s3_client.delete_object(Bucket=results_bucket, Key=results_file_prefix)
-        s3_client.delete_object(
-            Bucket=results_bucket, Key=results_file_prefix + ".metadata"
+        if small_result:
+            df = _get_query_results_as_dataframe(athena, query_execution_id)
+        else:
+            obj = s3_client.get_object(Bucket=results_bucket, Key=results_file_prefix)
+            df = pd.read_csv(io.BytesIO(obj["Body"].read()))
+
+        s3_client.delete_objects(
+            Bucket=results_bucket,
+            Delete={
+                "Objects": [
+                    {"Key": results_file_prefix},
+                    {"Key": results_file_prefix + ".metadata"},
+                ],
+                "Quiet": True,
+            },
         )
         return df
 
@@ -315,6 +477,7 @@ def get_historical_record_count(fg_name, sagemaker_session, s3_uri=None):
         _database,
         sagemaker_session.boto_region_name,
         verbose=False,
+        small_result=True,
     )
     return _tmp_df.iat[0, 0]
 
@@ -330,6 +493,7 @@ def wait_for_offline_data(feature_group_name, df, sagemaker_session):
     df_count = df.shape[0]
     # Before extracting the data we need to check if the offline feature store was populated
     offline_store_contents = None
+    attempt = 0
     while offline_store_contents is None:
         fg_record_count = get_historical_record_count(
             feature_group_name, sagemaker_session
@@ -341,7 +505,8 @@ def wait_for_offline_data(feature_group_name, df, sagemaker_session):
             offline_store_contents = fg_record_count
         else:
             print("Waiting for data in offline store...")
-            time.sleep(60)
+            time.sleep(_backoff_delay(attempt, base=5, cap=60))
+            attempt += 1
 
 
 def _wait_for_feature_group_deletion_complete(feature_group_name):
@@ -380,6 +545,42 @@ def describe_feature_group(fg_name):
     return sagemaker_client.describe_feature_group(FeatureGroupName=fg_name)
 
 
+def _delete_s3_prefix(bucket_name, prefix, max_workers=16):
+    """Delete every s3 object under a prefix, in parallel batches of 1000 keys
+
+    Args:
+        bucket_name (str): Bucket name
+        prefix (str): Key prefix to delete
+        max_workers (int, optional): Number of concurrent DeleteObjects calls. Defaults to 16.
+    """
+    s3_client = boto3.client("s3", config=Config(max_pool_connections=max_workers))
+    paginator = s3_client.get_paginator("list_objects_v2")
+
+    def delete_batch(keys):
+        # Quiet mode only reports the keys that failed to delete
+        response = s3_client.delete_objects(
+            Bucket=bucket_name,
+            Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True},
+        )
+        return response.get("Errors", [])
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        # list_objects_v2 pages hold at most 1000 keys, the DeleteObjects limit
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            keys = [obj["Key"] for obj in page.get("Contents", [])]
+            if keys:
+                futures.append(executor.submit(delete_batch, keys))
+        errors = [error for future in futures for error in future.result()]
+
+    for error in errors:
+        print(f"Failed to delete s3 object {error['Key']}: {error['Code']}")
+    if errors:
+        raise SystemExit(
+            f"Failed to delete {len(errors)} s3 objects in prefix: {prefix} in bucket {bucket_name}"
+        )
+
+
 def delete_feature_group(fg_name, delete_s3=True):
     """Delete a feature group
 
@@ -387,15 +588,15 @@ def delete_feature_group(fg_name, delete_s3=True):
         fg_name (str): Feature group name
         delete_s3 (bool, optional): Delete the offline feature group data. Defaults to True.
     """
-    has_offline_store = True
     try:
-        describe_feature_group(fg_name)["OfflineStoreConfig"]
-    except:
-        has_offline_store = False
-        pass
+        desc = describe_feature_group(fg_name)
+    except sagemaker_client.exceptions.ResourceNotFound:
+        print(f"Feature group {fg_name} does not exist")
+        return
+    has_offline_store = "OfflineStoreConfig" in desc
 
     if has_offline_store:
-        offline_store_config = describe_feature_group(fg_name)["OfflineStoreConfig"]
+        offline_store_config = desc["OfflineStoreConfig"]
         if not offline_store_config["DisableGlueTableCreation"]:
             table_name = offline_store_config["DataCatalogConfig"]["TableName"]
             catalog_id = offline_store_config["DataCatalogConfig"]["Catalog"]
@@ -403,19 +604,14 @@ def delete_feature_group(fg_name, delete_s3=True):
 
     # Delete s3 objects from offline store for this FG
     if delete_s3 and has_offline_store:
-        s3_uri = describe_feature_group(fg_name)["OfflineStoreConfig"][
-            "S3StorageConfig"
-        ]["S3Uri"]
+        s3_uri = offline_store_config["S3StorageConfig"]["S3Uri"]
         base_offline_prefix = "/".join(s3_uri.split("/")[3:])
         offline_prefix = f"{base_offline_prefix}/{account_id}/sagemaker/{region}/offline-store/{fg_name}"
         s3_bucket_name = s3_uri.split("/")[2]
-        s3 = boto3.resource("s3")
-        bucket = s3.Bucket(s3_bucket_name)
-        coll = bucket.objects.filter(Prefix=offline_prefix)
         print(
             f"Deleting all s3 objects in prefix: {offline_prefix} in bucket {s3_bucket_name}"
         )
-        resp = coll.delete()
+        _delete_s3_prefix(s3_bucket_name, offline_prefix)
 
     resp = None
     try: